@@ -1,87 +1,311 @@
 #!/usr/bin/env python3
 
-import json
 import os
-import requests
-import subprocess
 import sys
-from urllib.parse import urlparse
-import urllib3
 
-urllib3.disable_warnings()
+# requests, orjson, subprocess, fnmatch, urllib.parse and concurrent.futures
+# are imported inside the functions that use them, so that non-PR invocations
+# skip their import cost.
+
+# Files whose patches are not worth reviewing and only bloat the Cody prompt
+SKIPPED_PATCH_PATTERNS = (
+    "*.lock",
+    "package-lock.json",
+    "*/package-lock.json",
+    "*.min.js",
+    "dist/*",
+    "*/dist/*",
+    "vendor/*",
+    "*/vendor/*",
+    "*.generated.*",
+)
+# Patches with more changed lines than this keep only their head and tail
+MAX_PATCH_CHANGES = 2000
+PATCH_HEAD_LINES = 200
+PATCH_TAIL_LINES = 50
+
+
+def create_session(token):
+    """
+    Creates the requests session shared by every GitHub API call, so they
+    reuse pooled keep-alive connections and the same authentication headers.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=10,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+            ),
+        ),
+    )
+    session.headers.update(
+        {
+            "Authorization": f"Bearer {token}",
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": "2022-11-28",
+        }
+    )
+    return session
+
+
+def json_loads(data):
+    """
+    Decodes JSON with orjson when it is installed, else with the stdlib.
+    """
+    try:
+        import orjson
+    except ImportError:
+        import json
+
+        return json.loads(data)
+    return orjson.loads(data)
 
 
-def get_pull_request_details(api_url, owner, repo, pr_number, token):
+def json_dumps(obj):
     """
-    Fetches details of a specific pull request from the GitHub API.
+    Encodes obj as JSON bytes with orjson when it is installed, else with
+    the stdlib.
     """
-    result = ""
+    try:
+        import orjson
+    except ImportError:
+        import json
 
-    # --- 1. Set up headers for authentication ---
-    headers = {
-        "Authorization": f"token {token}",
-        "Accept": "application/vnd.github.v3+json",
-    }
+        return json.dumps(obj).encode("utf-8")
+    return orjson.dumps(obj)
 
-    # --- 2. Get the main PR data (title and body) ---
-    pr_api_url = f"{api_url}/repos/{owner}/{repo}/pulls/{pr_number}"
+
+def load_cache(pr_number):
+    """
+    Loads the cached GitHub API responses for a pull request from the
+    directory in CODY_CACHE_DIR. Returns the cache file path (None when
+    caching is disabled) and the cache mapping URL -> ETag, data and links.
+    """
+    if not (cache_dir := os.environ.get("CODY_CACHE_DIR")):
+        return None, {}
+    cache_path = os.path.join(cache_dir, f"{pr_number}.json")
     try:
-        response = requests.get(pr_api_url, headers=headers, verify=False)
-        response.raise_for_status()  # Raise an exception for bad status codes
-        pr_data = response.json()
-
-        result += "--- Pull Request Details ---\n"
-        result += f"Title: {pr_data.get('title')}\n"
-        result += f"Body:\n{pr_data.get('body')}\n\n"
-
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching files data: {e}")
-        if e.response is not None:
-            print(f"API Response: {e.response.text}")
-            exit(1)
+        with open(cache_path, "rb") as f:
+            return cache_path, json_loads(f.read())
+    except (OSError, ValueError):
+        return cache_path, {}
 
-    # --- 4. Get the list of changed files and their patches ---
-    files_api_url = f"{pr_api_url}/files"
+
+def save_cache(cache_path, cache):
+    """
+    Writes the GitHub API response cache back to disk.
+    """
+    if cache_path is None:
+        return
     try:
-        response = requests.get(files_api_url, headers=headers, verify=False)
-        response.raise_for_status()
-        files_data = response.json()
-
-        result += "--- Changed Files ---\n"
-        for file_info in files_data:
-            result += f"File Name: {file_info.get('filename')}\n"
-            patch = file_info.get("patch", "No patch data available.")
-            result += "Patch:\n"
-            result += "--------------------------------\n"
-            result += f"{patch}\n"
-            result += "--------------------------------"
-
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching files data: {e}")
-        if e.response is not None:
-            print(f"API Response: {e.response.text}")
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "wb") as f:
+            f.write(json_dumps(cache))
+    except OSError as e:
+        print(f"Unable to write the GitHub API cache: {e}")
+
+
+def get_json(session, url, cache):
+    """
+    GETs a GitHub API URL, revalidating a cached copy with If-None-Match so
+    an unchanged resource comes back as an empty 304 response.
+    Returns the decoded JSON and the parsed Link header.
+    """
+    headers = {}
+    if cached := cache.get(url):
+        headers["If-None-Match"] = cached["etag"]
+
+    response = session.get(url, headers=headers, timeout=30)
+    if cached and response.status_code == 304:
+        return cached["data"], cached["links"]
+    response.raise_for_status()  # Raise an exception for bad status codes
+
+    data = json_loads(response.content)
+    if etag := response.headers.get("ETag"):
+        cache[url] = {"etag": etag, "data": data, "links": response.links}
+    return data, response.links
+
+
+def get_remaining_pages(session, url, links, cache):
+    """
+    Fetches pages 2..last of a paginated GitHub API listing concurrently,
+    using the rel="last" link of the first page.
+    """
+    from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+    from urllib.parse import parse_qs, urlparse
+
+    if not (last_url := links.get("last", {}).get("url")):
+        return []
+    last_page = int(parse_qs(urlparse(last_url).query)["page"][0])
+
+    def get_page(page):
+        page_data, _ = get_json(session, f"{url}&page={page}", cache)
+        return page_data
+
+    executor = ThreadPoolExecutor(max_workers=min(last_page - 1, 10))
+    futures = [executor.submit(get_page, page) for page in range(2, last_page + 1)]
+    done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+    for future in done:
+        if (error := future.exception()) is not None:
+            # The job is going to fail, so drop the pages still queued
+            # instead of fetching them first
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise error
+    executor.shutdown()
+
+    # Collect in page order, so the listing stays in GitHub's order
+    data = []
+    for future in futures:
+        data.extend(future.result())
+    return data
+
+
+def is_whitespace_only(patch):
+    """
+    Returns True when the removed and added lines of a patch differ only in
+    trailing whitespace or line endings. Indentation and inner spacing are
+    kept, since they can change meaning (e.g. Python, YAML, string literals).
+    """
+    removed, added = [], []
+    for line in patch.splitlines():
+        if line.startswith("-"):
+            removed.append(line[1:].rstrip())
+        elif line.startswith("+"):
+            added.append(line[1:].rstrip())
+    return bool(removed or added) and removed == added
+
+
+def compact_patch(file_info):
+    """
+    Returns the patch to include in the prompt for a changed file, omitting
+    generated, vendored and lock files and whitespace-only changes, and
+    cutting oversized patches down to their first and last lines.
+    """
+    from fnmatch import fnmatchcase
+
+    filename = file_info.get("filename", "")
+    if any(fnmatchcase(filename, pattern) for pattern in SKIPPED_PATCH_PATTERNS):
+        return "Patch omitted (generated, vendored or lock file)."
+
+    patch = file_info.get("patch", "No patch data available.")
+    if "patch" in file_info and is_whitespace_only(patch):
+        return "Patch omitted (trailing whitespace or line ending changes only)."
+    if file_info.get("changes", 0) <= MAX_PATCH_CHANGES:
+        return patch
+
+    lines = patch.splitlines()
+    if (omitted := len(lines) - PATCH_HEAD_LINES - PATCH_TAIL_LINES) <= 0:
+        return patch
+    return "\n".join(
+        lines[:PATCH_HEAD_LINES]
+        + [f"... ({omitted} lines omitted) ..."]
+        + lines[-PATCH_TAIL_LINES:]
+    )
+
+
+def get_pull_request_details(session, repo_base, pr_number):
+    """
+    Fetches details of a specific pull request from the GitHub API.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import requests
+
+    parts = []
+    cache_path, cache = load_cache(pr_number)
+
+    pr_api_url = f"{repo_base}/pulls/{pr_number}"
+    files_api_url = f"{repo_base}/pulls/{pr_number}/files?per_page=100"
+
+    # Issue both requests at once so the fetch costs one round-trip, not two
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pr_future = executor.submit(get_json, session, pr_api_url, cache)
+        files_future = executor.submit(
+            get_json, session, files_api_url, cache
+        )
+
+        # --- 1. Get the main PR data (title and body) ---
+        try:
+            pr_data, _ = pr_future.result()
+
+            parts.append(
+                "--- Pull Request Details ---\n"
+                f"Title: {pr_data.get('title')}\n"
+                f"Body:\n{pr_data.get('body')}\n\n"
+            )
+
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # ValueError covers a response body that is not valid JSON
+            print(f"Error fetching pull request data: {e}")
+            if (response := getattr(e, "response", None)) is not None:
+                print(f"API Response: {response.text}")
+            # The review is useless without this data. Leaving the executor
+            # still waits for the in-flight files request, which is bounded
+            # by its timeout and retries, before the process exits.
+            exit(1)
+
+        # --- 2. Get the list of changed files and their patches ---
+        try:
+            files_data, links = files_future.result()
+            files_data = files_data + get_remaining_pages(
+                session, files_api_url, links, cache
+            )
+
+            parts.append("--- Changed Files ---\n")
+            for file_info in files_data:
+                patch = compact_patch(file_info)
+                parts.append(
+                    f"File Name: {file_info.get('filename')}\n"
+                    "Patch:\n"
+                    "--------------------------------\n"
+                    f"{patch}\n"
+                    "--------------------------------"
+                )
+
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # ValueError covers a response body that is not valid JSON
+            print(f"Error fetching files data: {e}")
+            if (response := getattr(e, "response", None)) is not None:
+                print(f"API Response: {response.text}")
             exit(1)
 
-    return result
+    save_cache(cache_path, cache)
+    return "".join(parts)
 
 
 def execute_cody_cli(repo, prompt):
-    command_list = ["cody", "chat", "--context-repo", repo, "-m", prompt]
+    import subprocess
+
+    # The prompt embeds every patch, so it goes through stdin rather than argv
+    command_list = ["cody", "chat", "--context-repo", repo, "--stdin"]
     try:
         # Execute the command
         # `shell=False` is the default, secure setting.
-        result = subprocess.run(
+        process = subprocess.Popen(
             command_list,
-            capture_output=True,
-            text=True,
-            check=False,  # We will check the return code manually
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # communicate() drains stdout and stderr together, so a chatty stderr
+        # cannot fill its pipe and deadlock the read of a long response
+        stdout_bytes, stderr_bytes = process.communicate(
+            input=prompt.encode("utf-8")
         )
-        if result.returncode == 0:
-            return result.stdout.strip()
+        if process.returncode == 0:
+            return stdout_bytes.decode("utf-8").strip()
         else:
-            print(result.stderr.strip())
+            print(stderr_bytes.decode("utf-8", errors="replace").strip())
             print("\n--- Command failed! ---", file=sys.stderr)
-            exit(result.returncode)
+            exit(process.returncode)
 
     except FileNotFoundError:
         print(f"Error: The command 'cody' was not found.", file=sys.stderr)
@@ -96,25 +320,18 @@ def execute_cody_cli(repo, prompt):
         exit(1)
 
 
-def add_pr_comment(api_url, owner, repo, pr_number, token, comment_body):
-    # GitHub API endpoint for creating a general PR comment (Issues API)
-    url = f"{api_url}/repos/{owner}/{repo}/issues/{pr_number}/comments"
+def add_pr_comment(session, repo_base, pr_number, comment_body):
+    import requests
 
-    # Headers with authentication
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/vnd.github+json",
-        "X-GitHub-Api-Version": "2022-11-28",
-    }
+    # GitHub API endpoint for creating a general PR comment (Issues API)
+    url = f"{repo_base}/issues/{pr_number}/comments"
 
     # Comment payload
     payload = {"body": comment_body}
 
     try:
         # Make the POST request
-        response = requests.post(
-            url, headers=headers, data=json.dumps(payload), verify=False
-        )
+        response = session.post(url, json=payload, timeout=30)
 
         # Check if the request was successful
         if response.status_code == 201:
@@ -150,6 +367,10 @@ if __name__ == "__main__":
             )
             exit(1)
 
+        from urllib.parse import urlparse
+
+        session = create_session(token)
+
         api_url = os.environ.get("GITHUB_API_URL", "https://api.github.com")
 
         # repo_host is api_url domain
@@ -161,9 +382,10 @@ if __name__ == "__main__":
         # parse the pull request number from env variable: GITHUB_REF=refs/pull/2/merge
         pr_number = os.environ.get("GITHUB_REF").split("/")[2]
 
-        pr_details = get_pull_request_details(
-            api_url, repo_owner, repo_name, pr_number, token
-        )
+        # base URL of the repository's REST API endpoints
+        repo_base = f"{api_url}/repos/{repo_owner}/{repo_name}"
+
+        pr_details = get_pull_request_details(session, repo_base, pr_number)
 
         cody_prompt = f"""You are an expert code reviewer tasked with analyzing the changes in a GitHub pull request (PR).
 Your review must focus **exclusively** on the modified, added, or removed lines in the PR diffs, as provided below.
@@ -223,7 +445,7 @@ Provide clear, actionable feedback on correctness, best practices, security, and
 """
 
         comment = execute_cody_cli(f"{repo_host}/{repo_owner}/{repo_name}", cody_prompt)
-        add_pr_comment(api_url, repo_owner, repo_name, pr_number, token, comment)
+        add_pr_comment(session, repo_base, pr_number, comment)
     else:
         print("Script intended to run only in GitHub Pull Request context")
         exit(1)